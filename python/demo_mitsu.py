@@ -9,10 +9,10 @@ from hvac_ircontrol.ir_sender import LogLevel
 from hvac_ircontrol.mitsubishi import Mitsubishi, ClimateMode, FanMode, VanneVerticalMode, VanneHorizontalMode, ISeeMode, AreaMode, PowerfulMode
 
 if __name__ == "__main__":
+    HVAC = Mitsubishi(23, LogLevel.ErrorsOnly)
     while True:
         print("=======================================================")
         print("Power OFF")
-        HVAC = Mitsubishi(23, LogLevel.ErrorsOnly)
         HVAC.power_off()
         print("Wait 2 secs ...")
         time.sleep(2)
@@ -8,6 +8,15 @@
 import ctypes
 import time
 
+# pigpio is initialised once for the whole process, and only terminated when the last
+# IrSender using it is closed.
+_pigpio_users = 0
+
+# pigpio's wave pool is shared by the whole process, so are the waves kept by send_kept_wave.
+# Wave ids by (gpio pin, carrier frequency, duty cycle, key), least recently sent first.
+MAX_KEPT_WAVES = 2 # pigpio's DMA control blocks only fit a couple of waves of ~5000 pulses
+_kept_waves = {}
+
 class LogLevel:
     ErrorsOnly = 0
     Minimal = 2
@@ -31,11 +40,17 @@ class Wave_generator():
         Pulses_array = Pulses_struct * MAX_PULSES
         self.pulses = Pulses_array()
         self.pulse_count = 0
+        self.bursts = {} # carrier bursts by mark duration
+        self.sequences = {} # pulses by sequence of mark and space durations
 
     def __log(self, min_log_level, message):
         if min_log_level <= self.log_level:
             print(message)
 
+    # Forget the pulses of the previous transmission
+    def clear(self):
+        self.pulse_count = 0
+
     def add_pulse(self, gpioOn, gpioOff, usDelay):
         self.pulses[self.pulse_count].gpioOn = gpioOn
         self.pulses[self.pulse_count].gpioOff = gpioOff
@@ -48,20 +63,52 @@ class Wave_generator():
         self.add_pulse(0, 1 << self.protocol.master.gpio_pin, duration)
 
     # Protocol-agnostic square wave generator
+    # The carrier burst of a given duration is generated once, then copied in a single memmove.
     def one(self, duration):
         self.__log(LogLevel.Verbose, " MARK\t%s" % duration)
+        burst = self.bursts.get(duration)
+        if burst is None:
+            burst = self.bursts[duration] = self.__carrier_burst(duration)
+        self.__add_block(burst)
+
+    # Add a sequence of alternating mark and space durations, starting with a mark.
+    # The pulses of a given sequence are generated once, then copied in a single memmove.
+    def add_sequence(self, durations):
+        block = self.sequences.get(durations)
+        if block is not None:
+            self.__add_block(block)
+            return
+        start = self.pulse_count
+        for i in range(0, len(durations), 2):
+            self.one(durations[i])
+            if i + 1 < len(durations):
+                self.zero(durations[i + 1])
+        block = self.sequences[durations] = (Pulses_struct * (self.pulse_count - start))()
+        ctypes.memmove(block, ctypes.byref(self.pulses, start * ctypes.sizeof(Pulses_struct)), ctypes.sizeof(block))
+
+    def __add_block(self, block):
+        if self.pulse_count + len(block) > len(self.pulses):
+            raise IndexError("too many pulses")
+        ctypes.memmove(ctypes.byref(self.pulses, self.pulse_count * ctypes.sizeof(Pulses_struct)), block, ctypes.sizeof(block))
+        self.pulse_count += len(block)
+
+    def __carrier_burst(self, duration):
         period_time = 1000000.0 / self.protocol.frequency
         on_duration = int(round(period_time * self.protocol.duty_cycle))
         off_duration = int(round(period_time * (1.0 - self.protocol.duty_cycle)))
         total_periods = int(round(duration/period_time))
         total_pulses = total_periods * 2
+        burst = (Pulses_struct * total_pulses)()
 
         # Generate square wave on the specified output pin
         for i in range(total_pulses):
             if i % 2 == 0:
-                self.add_pulse(1 << self.protocol.master.gpio_pin, 0, on_duration)
+                burst[i].gpioOn = 1 << self.protocol.master.gpio_pin
+                burst[i].usDelay = on_duration
             else:
-                self.add_pulse(0, 1 << self.protocol.master.gpio_pin, off_duration)
+                burst[i].gpioOff = 1 << self.protocol.master.gpio_pin
+                burst[i].usDelay = off_duration
+        return burst
 
 # NEC protocol class
 class NEC():
@@ -241,14 +288,18 @@ class RAW():
 
 class IrSender():
     def __init__(self, gpio_pin, protocol, protocol_config, log_level = LogLevel.Minimal):
+        global _pigpio_users
         self.log_level = log_level
         
         self.__log(LogLevel.Minimal, "Starting IR")
         self.__log(LogLevel.Normal, "Loading libpigpio.so")
         self.pigpio = ctypes.CDLL('libpigpio.so')
-        self.__log(LogLevel.Normal, "Initializing pigpio")
         PI_OUTPUT = 1 # from pigpio.h
-        self.pigpio.gpioInitialise()
+        if _pigpio_users == 0:
+            self.__log(LogLevel.Normal, "Initializing pigpio")
+            self.pigpio.gpioInitialise()
+        _pigpio_users += 1
+        self.closed = False
         self.gpio_pin = gpio_pin
         self.__log(LogLevel.Normal, "Configuring pin %d as output" % self.gpio_pin)
         self.pigpio.gpioSetMode(self.gpio_pin, PI_OUTPUT) # pin 17 is used in LIRC by default
@@ -272,38 +323,106 @@ class IrSender():
     # IR code itself is processed and converted to pigpio structs by protocol's classes.
     def send_code(self, ircode, nb = 1):
         self.__log(LogLevel.Normal, "Processing IR code: %s" % ' '.join([ ircode[i:i+8] for i in range(0, len(ircode), 8) ]))
-        for _ in range(0, nb):
-            code = self.protocol.process_code(ircode)
-            if code != 0:
-                self.__log(LogLevel.ErrorsOnly, "Error in processing IR code!")
-                return 1
-        clear = self.pigpio.gpioWaveClear()
-        if clear != 0:
-            self.__log(LogLevel.ErrorsOnly, "Error in clearing wave!")
+        self.protocol.wave_generator.clear()
+        code = self.protocol.process_code(ircode)
+        if code != 0:
+            self.__log(LogLevel.ErrorsOnly, "Error in processing IR code!")
             return 1
-        pulses = self.pigpio.gpioWaveAddGeneric(self.protocol.wave_generator.pulse_count, self.protocol.wave_generator.pulses)
-        if pulses < 0:
-            self.__log(LogLevel.ErrorsOnly, "Error in adding wave!")
-            return 1
-        wave_id = self.pigpio.gpioWaveCreate()
-        # Unlike the C implementation, in Python the wave_id seems to always be 0.
-        if wave_id >= 0:
-            self.__log(LogLevel.Normal, "Sending wave...")
-            result = self.pigpio.gpioWaveTxSend(wave_id, 0)
-            if result >= 0:
-                self.__log(LogLevel.Normal, "Success! (result: %d)" % result)
-            else:
-                self.__log(LogLevel.ErrorsOnly, "Error sending wave! (result: %d)" % result)
+        return self.__transmit(nb)
+
+    # send_kept_wave sends IR data nb times. build_sequences is only called when no wave is
+    # kept for the key yet, and returns the data as tuples of alternating mark and space
+    # durations (in microseconds, starting with a mark). Each distinct tuple is only turned
+    # into pulses once. The key must identify these durations: the wave is kept under it,
+    # along with this pin and carrier, and sending the same key again only triggers the
+    # transmission. At most MAX_KEPT_WAVES waves are kept for the whole process, the least
+    # recently sent one being dropped.
+    def send_kept_wave(self, key, build_sequences, nb = 1):
+        key = (self.gpio_pin, self.protocol.frequency, self.protocol.duty_cycle, key)
+        wave_id = _kept_waves.pop(key, None)
+        if wave_id is None:
+            if len(_kept_waves) >= MAX_KEPT_WAVES:
+                self.__delete_wave(_kept_waves.pop(next(iter(_kept_waves))))
+            sequences = build_sequences()
+            self.__log(LogLevel.Normal, "Creating IR wave: %d sequences" % len(sequences))
+            wave_generator = self.protocol.wave_generator
+            wave_generator.clear()
+            for sequence in sequences:
+                wave_generator.add_sequence(sequence)
+            wave_id = self.__create_wave()
+            if wave_id < 0:
                 return 1
+        _kept_waves[key] = wave_id
+        return self.__send_wave_id(wave_id, nb)
+
+    # Send a registered wave nb times and wait for the end of the transmission.
+    def __send_wave_id(self, wave_id, nb = 1):
+        self.__log(LogLevel.Normal, "Sending wave...")
+        if nb > 1:
+            # Let pigpio repeat the wave: loop start, wave, loop end repeated nb times
+            chain = bytes([255, 0, wave_id, 255, 1, nb & 0xFF, nb >> 8])
+            result = self.pigpio.gpioWaveChain((ctypes.c_char * len(chain)).from_buffer_copy(chain), len(chain))
         else:
-            self.__log(LogLevel.ErrorsOnly, "Error creating wave: %d" % wave_id)
+            result = self.pigpio.gpioWaveTxSend(wave_id, 0)
+        if result >= 0:
+            self.__log(LogLevel.Normal, "Success! (result: %d)" % result)
+        else:
+            self.__log(LogLevel.ErrorsOnly, "Error sending wave! (result: %d)" % result)
             return 1
         while self.pigpio.gpioWaveTxBusy():
             time.sleep(0.1)
+        return 0
+
+    def __delete_wave(self, wave_id):
         self.__log(LogLevel.Normal, "Deleting wave")
         self.pigpio.gpioWaveDelete(wave_id)
-        self.__log(LogLevel.Minimal, "Terminating pigpio")
-        self.pigpio.gpioTerminate()
+
+    # Register the pulses of the wave generator as a pigpio wave.
+    # When pigpio is out of room, the waves kept by every sender of the process are dropped
+    # and the creation is tried again.
+    def __create_wave(self):
+        had_kept_waves = len(_kept_waves) > 0
+        wave_id = self.__add_wave()
+        if wave_id < 0 and had_kept_waves:
+            self.__log(LogLevel.Normal, "No room left in pigpio, kept waves dropped")
+            wave_id = self.__add_wave()
+        if wave_id < 0:
+            self.__log(LogLevel.ErrorsOnly, "Error creating wave: %d" % wave_id)
+        return wave_id
+
+    def __add_wave(self):
+        pulses = self.pigpio.gpioWaveAddGeneric(self.protocol.wave_generator.pulse_count, self.protocol.wave_generator.pulses)
+        wave_id = pulses if pulses < 0 else self.pigpio.gpioWaveCreate()
+        if wave_id < 0:
+            # pigpio leaves the pulses of a failed attempt pending, they would end up in the
+            # next wave. Clearing them deletes every wave, so the kept ones are forgotten too
+            # (other waves only live during a transmission).
+            _kept_waves.clear()
+            self.pigpio.gpioWaveClear()
+        return wave_id
+
+    # Hand the pulses of the wave generator to pigpio as a single wave, send it nb times
+    # and delete it. Waves kept by send_kept_wave are left untouched.
+    def __transmit(self, nb = 1):
+        wave_id = self.__create_wave()
+        if wave_id < 0:
+            return 1
+        result = self.__send_wave_id(wave_id, nb)
+        self.__delete_wave(wave_id)
+        return result
+
+    # close releases pigpio, the sender can't be used afterwards.
+    # pigpio is only terminated once every IrSender of the process is closed.
+    def close(self):
+        global _pigpio_users
+        if self.closed:
+            return
+        self.closed = True
+        _pigpio_users -= 1
+        if _pigpio_users == 0:
+            self.__log(LogLevel.Minimal, "Terminating pigpio")
+            self.pigpio.gpioTerminate()
+            _kept_waves.clear()
 
     def send_data(self, data, maxMask, mustInvert, nb = 1):
         code = []
@@ -6,18 +6,41 @@
 # From original: https://github.com/r45635/HVAC-IR-Control
 # (c)  Vincent Cruvellier - 10th, January 2016 - Fun with ESP8266
 
-import ir_sender
+import os
+import struct
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from functools import lru_cache
+from itertools import chain
 import pigpio
-from datetime import datetime
+from . import ir_sender
 
-class PowerMode:
+__all__ = [
+    'PowerMode',
+    'ClimateMode',
+    'ISeeMode',
+    'PowerfulMode',
+    'VanneHorizontalMode',
+    'FanMode',
+    'VanneVerticalMode',
+    'TimeControlMode',
+    'AreaMode',
+    'Delay',
+    'Index',
+    'Constants',
+    'frame_to_sequences',
+    'Mitsubishi',
+]
+
+class PowerMode(IntEnum):
     """
     PowerMode
     """
     PowerOff = 0b00000000       # 0x00      0000 0000        0
     PowerOn = 0b00100000        # 0x20      0010 0000       32
 
-class ClimateMode:
+class ClimateMode(IntEnum):
     """
     ClimateMode
     """
@@ -26,41 +49,37 @@ class ClimateMode:
     Dry = 0b00010000            # 0x10      0001 0000       16
     Auto = 0b00100000           # 0x20      0010 0000       32
 
-    __Hot2 = 0b00000000         # 0x00      0000 0000        0
-    __Cold2 = 0b00000110        # 0x06      0000 0110        6
-    __Dry2 = 0b00000010         # 0x02      0000 0010        2
-    __Auto2 = 0b00000000        # 0x00      0000 0000        0
-
     @classmethod
     def climate2(cls, climate_mode):
         """
         climate2: Converts to the second climate value (For ClimateAndHorizontalVanne)
         """
-        if climate_mode == cls.Hot:
-            return cls.__Hot2
-        if climate_mode == cls.Cold:
-            return cls.__Cold2
-        if climate_mode == cls.Dry:
-            return cls.__Dry2
-        if climate_mode == cls.Auto:
-            return cls.__Auto2
+        return _CLIMATE2.get(climate_mode)
+
+# Second climate value (For ClimateAndHorizontalVanne)
+_CLIMATE2 = {
+    ClimateMode.Hot: 0b00000000,    # 0x00      0000 0000        0
+    ClimateMode.Cold: 0b00000110,   # 0x06      0000 0110        6
+    ClimateMode.Dry: 0b00000010,    # 0x02      0000 0010        2
+    ClimateMode.Auto: 0b00000000,   # 0x00      0000 0000        0
+}
 
 
-class ISeeMode:
+class ISeeMode(IntEnum):
     """
     ISeeMode
     """
     ISeeOff = 0b00000000        # 0x00      0000 0000        0
     ISeeOn = 0b01000000         # 0x40      0100 0000       64
     
-class PowerfulMode:
+class PowerfulMode(IntEnum):
     """
     PowerfulMode
     """
     PowerfulOff = 0b00000000        # 0x00      0000 0000        0
     PowerfulOn = 0b00001000         # 0x08      0000 1000        8
 
-class VanneHorizontalMode:
+class VanneHorizontalMode(IntEnum):
     """
     VanneHorizontalMode
     """
@@ -72,7 +91,7 @@ class VanneHorizontalMode:
     Right = 0b01010000          # 0x50      0101 0000       80
     Swing = 0b11000000          # 0xC0      1100 0000      192
 
-class FanMode:
+class FanMode(IntEnum):
     """
     FanMode
     """
@@ -81,7 +100,7 @@ class FanMode:
     Speed3 = 0b00000011         # 0x03      0000 0011        3
     Auto = 0b10000000           # 0x80      1000 0000      128
 
-class VanneVerticalMode:
+class VanneVerticalMode(IntEnum):
     """
     VanneVerticalMode
     """
@@ -93,7 +112,7 @@ class VanneVerticalMode:
     Bottom = 0b01101000         # 0x68      0110 1000      104
     Swing = 0b01111000          # 0x78      0111 1000      120
 
-class TimeControlMode:
+class TimeControlMode(IntEnum):
     """
     TimeControlMode
     """
@@ -102,7 +121,15 @@ class TimeControlMode:
     ControlEnd = 0b00000011     # 0x03      0000 0011        3
     ControlBoth = 0b00000111    # 0x07      0000 0111        7
 
-class AreaMode:
+# TimeControlMode indexed by (StartTime is set) << 1 | (EndTime is set)
+_TIME_CONTROL = (
+    TimeControlMode.NoTimeControl,
+    TimeControlMode.ControlEnd,
+    TimeControlMode.ControlStart,
+    TimeControlMode.ControlBoth,
+)
+
+class AreaMode(IntEnum):
     """
     AreaMode
     """
@@ -157,13 +184,104 @@ class Constants:
     NbBytes = 18
     NbPackets = 2           # For Mitsubishi IR protocol we have to send two time the packet data
 
+# Sum of the header bytes (Header0 to Header4), which never change
+_BASE_SUM = sum([0x23, 0xCB, 0x26, 0x01, 0x00]) & Constants.MaxMask
+
+@lru_cache(maxsize=64)
+def _build_frame(power_mode, climate_mode, temperature, fan_mode, vanne_vertical_mode, vanne_horizontal_mode, isee_mode, area_mode, time_control, powerful):
+    """
+    _build_frame: Builds the frame for the given settings, Clock, EndTime and StartTime being left to 0
+    The CRC byte holds the sum of that frame, the caller only has to add the bytes it patches.
+    """
+    # data array is a valid trame, only byte to be chnaged will be updated.
+    data = bytearray(b'\x23\xCB\x26\x01\x00\x20'
+                     b'\x08\x06\x30\x45\x67\x00'
+                     b'\x00\x00\x10\x00\x00\x1F')
+
+    # Power to TimeControlAndArea, Clock, EndTime and StartTime included
+    struct.pack_into('9B', data, Index.Power,
+                     power_mode,
+                     climate_mode | isee_mode,
+                     max(Constants.MinTemp, min(Constants.MaxTemp, temperature)) - Constants.MinTemp,
+                     _CLIMATE2.get(climate_mode, 0) | vanne_horizontal_mode,
+                     fan_mode | vanne_vertical_mode,
+                     0,
+                     0,
+                     0,
+                     time_control | area_mode)
+    data[Index.PowerfulMode] = powerful
+
+    # CRC is a simple bits addition
+    # sum every bytes but the last one, the header part being precomputed
+    data[Index.CRC] = (_BASE_SUM + sum(data[Index.Power:Index.CRC])) & Constants.MaxMask
+    return bytes(data)
+
+# Mark and space durations of every byte value, bits being sent from the lowest to the highest
+_BYTE_TO_PULSES = [
+    tuple(chain.from_iterable(
+        (Delay.BitMark, Delay.OneSpace if (b >> bit) & 1 else Delay.ZeroSpace) for bit in range(8)))
+    for b in range(Constants.MaxMask + 1)]
+
+_HEADER = (Delay.HdrMark, Delay.HdrSpace)
+_TRAILER = (Delay.RptMark, Delay.RptSpace)
+
+def frame_to_sequences(data):
+    """
+    frame_to_sequences: Converts a frame to the mark and space durations of one packet, as one tuple per byte between the header and the trailer
+    """
+    sequences = [_HEADER]
+    sequences.extend(_BYTE_TO_PULSES[b] for b in data)
+    sequences.append(_TRAILER)
+    return sequences
+
+@contextmanager
+def _realtime_priority(priority=80):
+    """
+    _realtime_priority: Runs the block under the SCHED_FIFO policy, yields False when it can't be raised
+    """
+    try:
+        policy = os.sched_getscheduler(0)
+        param = os.sched_getparam(0)
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        raised = True
+    except (AttributeError, OSError):
+        # Not on Linux or missing CAP_SYS_NICE
+        raised = False
+    # Yield outside of the handler, errors of the block would be chained to it otherwise
+    if not raised:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        os.sched_setscheduler(0, policy, param)
+
 class Mitsubishi:
     """
     Mitsubishi
     """
+    __slots__ = ('log_level', 'gpio_pin', '_realtime_warned', '_frame', '_sender')
+
     def __init__(self, gpio_pin, log_level=ir_sender.LogLevel.Minimal):
         self.log_level = log_level
         self.gpio_pin = gpio_pin
+        self._realtime_warned = False
+        self._frame = bytearray(Constants.NbBytes)
+        self._sender = ir_sender.IrSender(gpio_pin, "NEC", dict(
+            leading_pulse_duration=Delay.HdrMark,
+            leading_gap_duration=Delay.HdrSpace,
+            one_pulse_duration=Delay.BitMark,
+            one_gap_duration=Delay.OneSpace,
+            zero_pulse_duration=Delay.BitMark,
+            zero_gap_duration=Delay.ZeroSpace,
+            trailing_pulse_duration=Delay.RptMark,
+            trailing_gap_duration=Delay.RptSpace), log_level)
+
+    def close(self):
+        """
+        close: Releases the IR sender, the instance can't send commands afterwards
+        """
+        self._sender.close()
 
     def power_off(self):
         """
@@ -215,77 +333,75 @@ class Mitsubishi:
 
     def __send_command(self, climate_mode, temperature, fan_mode, vanne_vertical_mode, vanne_horizontal_mode, isee_mode, area_mode, start_time, end_time, powerful, power_mode):
 
-        sender = ir_sender.IrSender(self.gpio_pin, "NEC", dict(
-            leading_pulse_duration=Delay.HdrMark,
-            leading_gap_duration=Delay.HdrSpace,
-            one_pulse_duration=Delay.BitMark,
-            one_gap_duration=Delay.OneSpace,
-            zero_pulse_duration=Delay.BitMark,
-            zero_gap_duration=Delay.ZeroSpace,
-            trailing_pulse_duration=Delay.RptMark,
-            trailing_gap_duration=Delay.RptSpace), self.log_level)
+        time_control = _TIME_CONTROL[((start_time is not None) << 1) | (end_time is not None)]
 
-        # data array is a valid trame, only byte to be chnaged will be updated.
-        data = [0x23, 0xCB, 0x26, 0x01, 0x00, 0x20,
-                0x08, 0x06, 0x30, 0x45, 0x67, 0x00,
-                0x00, 0x00, 0x10, 0x00, 0x00, 0x1F]
+        # Everything but the clock and the timers only depends on the settings,
+        # so the frame is built once per settings and patched afterwards in the instance buffer.
+        data = self._frame
+        data[:] = _build_frame(
+            power_mode,
+            climate_mode,
+            temperature,
+            fan_mode,
+            vanne_vertical_mode,
+            vanne_horizontal_mode,
+            isee_mode,
+            area_mode,
+            time_control,
+            powerful)
 
         self.__log(ir_sender.LogLevel.Verbose, '')
-        data[Index.Power] = power_mode
         self.__log(ir_sender.LogLevel.Verbose, 'PWR: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.Power]))
         self.__log(ir_sender.LogLevel.Verbose, '')
-        data[Index.ClimateAndISee] = climate_mode | isee_mode
         self.__log(ir_sender.LogLevel.Verbose, 'CLI: {0:03d}  {0:02x}  {0:08b}'.format(climate_mode))
         self.__log(ir_sender.LogLevel.Verbose, 'SEE: {0:03d}  {0:02x}  {0:08b}'.format(isee_mode))
         self.__log(ir_sender.LogLevel.Verbose, 'CLS: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.ClimateAndISee]))
         self.__log(ir_sender.LogLevel.Verbose, '')
-        data[Index.Temperature] = max(Constants.MinTemp, min(Constants.MaxTemp, temperature)) - 16
         self.__log(ir_sender.LogLevel.Verbose, 'TMP: {0:03d}  {0:02x}  {0:08b} (asked: {1})'.format(data[Index.Temperature], temperature))
         self.__log(ir_sender.LogLevel.Verbose, '')
-        data[Index.ClimateAndHorizontalVanne] = ClimateMode.climate2(climate_mode) | vanne_horizontal_mode
-        self.__log(ir_sender.LogLevel.Verbose, 'CLI: {0:03d}  {0:02x}  {0:08b}'.format(ClimateMode.climate2(climate_mode)))
+        self.__log(ir_sender.LogLevel.Verbose, 'CLI: {0:03d}  {0:02x}  {0:08b}'.format(_CLIMATE2.get(climate_mode, 0)))
         self.__log(ir_sender.LogLevel.Verbose, 'HOR: {0:03d}  {0:02x}  {0:08b}'.format(vanne_horizontal_mode))
         self.__log(ir_sender.LogLevel.Verbose, 'CLH: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.ClimateAndHorizontalVanne]))
         self.__log(ir_sender.LogLevel.Verbose, '')
-        data[Index.FanAndVerticalVanne] = fan_mode | vanne_vertical_mode
         self.__log(ir_sender.LogLevel.Verbose, 'FAN: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.FanAndVerticalVanne]))
         self.__log(ir_sender.LogLevel.Verbose, '')
 
-        now = datetime.today()
-        data[Index.Clock] = (now.hour*6) + (now.minute//10)
-        self.__log(ir_sender.LogLevel.Verbose, 'CLK: {0:03d}  {0:02x}  {0:08b} {1}'.format(data[Index.Clock], now))
+        # The clock is only needed by the timers, the cached frame already has all three bytes to 0 otherwise
+        if time_control != TimeControlMode.NoTimeControl:
+            now = time.localtime()
+            struct.pack_into('3B', data, Index.Clock,
+                             (now.tm_hour*6) + (now.tm_min//10),
+                             0 if end_time is None else ((end_time.hour*6) + (end_time.minute//10)),
+                             0 if start_time is None else ((start_time.hour*6) + (start_time.minute//10)))
+            self.__log(ir_sender.LogLevel.Verbose, 'CLK: {0:03d}  {0:02x}  {0:08b} {1:02d}:{2:02d}'.format(data[Index.Clock], now.tm_hour, now.tm_min))
+        else:
+            self.__log(ir_sender.LogLevel.Verbose, 'CLK: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.Clock]))
         self.__log(ir_sender.LogLevel.Verbose, '')
 
-        data[Index.EndTime] = 0 if end_time is None else ((end_time.hour*6) + (end_time.minute//10))
         self.__log(ir_sender.LogLevel.Verbose, 'ETI: {0:03d}  {0:02x}  {0:08b} {1}'.format(data[Index.EndTime], end_time))
         self.__log(ir_sender.LogLevel.Verbose, '')
-        data[Index.StartTime] = 0 if start_time is None else ((start_time.hour*6) + (start_time.minute//10))
         self.__log(ir_sender.LogLevel.Verbose, 'STI: {0:03d}  {0:02x}  {0:08b} {1}'.format(data[Index.StartTime], start_time))
         self.__log(ir_sender.LogLevel.Verbose, '')
 
-        time_control = TimeControlMode.NoTimeControl
-        if end_time is not None and start_time is not None:
-            time_control = TimeControlMode.ControlBoth
-        elif end_time is not None:
-            time_control = TimeControlMode.ControlEnd
-        elif start_time is not None:
-            time_control = TimeControlMode.ControlStart
-        else:
-            time_control = TimeControlMode.NoTimeControl
-        data[Index.TimeControlAndArea] = time_control | area_mode 
         self.__log(ir_sender.LogLevel.Verbose, 'TIC: {0:03d}  {0:02x}  {0:08b}'.format(time_control))
         self.__log(ir_sender.LogLevel.Verbose, 'AEA: {0:03d}  {0:02x}  {0:08b}'.format(area_mode))
         self.__log(ir_sender.LogLevel.Verbose, 'TCA: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.TimeControlAndArea]))
         self.__log(ir_sender.LogLevel.Verbose, '')
-        
-        data[Index.PowerfulMode] = powerful
+
         self.__log(ir_sender.LogLevel.Verbose, 'FUL: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.PowerfulMode]))
         self.__log(ir_sender.LogLevel.Verbose, '')
 
-        # CRC is a simple bits addition
-        # sum every bytes but the last one
-        data[Index.CRC] = sum(data[:-1]) % (Constants.MaxMask + 1)
+        # The cached CRC covers everything but the clock and the timers
+        data[Index.CRC] = (data[Index.CRC] + data[Index.Clock] + data[Index.EndTime] + data[Index.StartTime]) & Constants.MaxMask
         self.__log(ir_sender.LogLevel.Verbose, 'CRC: {0:03d}  {0:02x}  {0:08b}'.format(data[Index.CRC]))
         self.__log(ir_sender.LogLevel.Verbose, '')
 
-        sender.send_data(data, Constants.MaxMask, True, Constants.NbPackets)
+        self.__log(ir_sender.LogLevel.Minimal, "Sending data:")
+        self.__log(ir_sender.LogLevel.Minimal, (' '.join('{:x}'.format(d) for d in data)).upper())
+        with _realtime_priority() as realtime:
+            if not realtime and not self._realtime_warned:
+                self._realtime_warned = True
+                self.__log(ir_sender.LogLevel.Minimal, "Can't raise the scheduling priority, sending anyway")
+            # Frames only depend on the settings (and the clock when a timer is set), so
+            # their pigpio wave is kept and sent again as is.
+            self._sender.send_kept_wave(bytes(data), lambda: frame_to_sequences(data), Constants.NbPackets)